@@ -1,11 +1,14 @@
 import os
+import numpy as np
 import pandas as pd
 from datetime import datetime
 import warnings
 import shutil
 import tempfile
 import re
-from flask import Flask, request, render_template, redirect, url_for, send_file, flash, session
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from flask import Flask, request, render_template, redirect, url_for, send_from_directory, flash, session
 from werkzeug.utils import secure_filename
 import logging
 
@@ -22,6 +25,8 @@ static_dir = os.path.join(BASE_DIR, '..', 'static')
 
 app = Flask(__name__, template_folder=template_dir, static_folder=static_dir)
 app.secret_key = os.environ.get('FLASK_SECRET_KEY', 'a_strong_default_secret_key_for_local_dev_only_change_this_in_production')
+# Behind a proxy that honours X-Sendfile (e.g. Apache mod_xsendfile), set USE_X_SENDFILE=1 so the proxy serves downloads
+app.config['USE_X_SENDFILE'] = os.environ.get('USE_X_SENDFILE') == '1'
 
 # --- Global Variables ---
 CONSOLIDATED_OUTPUT_COLUMNS = [
@@ -31,6 +36,18 @@ CONSOLIDATED_OUTPUT_COLUMNS = [
     'Remarks', 'Aging', 'Today'
 ]
 
+# PISA records are only consolidated when assigned to one of these users
+ALLOWED_PISA_USERS = frozenset([
+    "Goswami Sonali", "Patil Jayapal Gowd", "Ranganath Chilamakuri", "Sridhar Divya", "Sunitha S", "Varunkumar N"
+])
+
+# Step 2 status transitions for central records whose barcode is in the consolidated data,
+# keyed by the stripped, lower-cased status; any other status is kept as-is
+CENTRAL_STATUS_TRANSITIONS = {'new': 'Untouched', 'completed': 'Reopen', 'n/a': 'New'}
+
+# Low-cardinality output columns that are held as pandas 'category' dtype in the consolidated DataFrame
+CATEGORICAL_OUTPUT_COLUMNS = ['Channel', 'Processor', 'Status', 'Region', 'Category']
+
 # Define expected output columns for PMD Lookup - Sheet 1
 PMD_OUTPUT_SHEET1_COLUMNS = [
     'Valid From', 'Bukr.', 'Type', 'EBSNO', 'Supplier Name', 'Street', 'City',
@@ -48,6 +65,29 @@ PMD_OUTPUT_SHEET2_COLUMNS = [
 
 ALLOWED_EXTENSIONS = {'xls', 'xlsx'}
 
+# Chunk size for copying uploads to disk (werkzeug's FileStorage.save default is 16 KiB)
+UPLOAD_COPY_BUFFER_SIZE = 1024 * 1024
+
+# Display names for the uploaded B-Segment input files, used in load error messages
+INPUT_FILE_LABELS = {
+    'pisa_file': 'PISA', 'esm_file': 'ESM', 'pm7_file': 'PM7',
+    'workon_file': 'Workon', 'rgpa_file': 'RGBA', 'smd_file': 'SMD'
+}
+
+# Workbook options for all xlsxwriter outputs. 'constant_memory' is deliberately not used:
+# DataFrame.to_excel writes column by column, which that mode silently truncates.
+XLSXWRITER_OPTIONS = {'strings_to_urls': False}
+
+# Temporary directories are removed on this pool so redirects do not wait for the filesystem walk
+CLEANUP_EXECUTOR = ThreadPoolExecutor(max_workers=2)
+
+# Precompiled patterns used by clean_column_names
+WHITESPACE_PATTERN = re.compile(r'\s+')
+NON_ALNUM_PATTERN = re.compile(r'[^a-z0-9_]')
+
+# Matches a zero padding a month/day field, e.g. the zeros in '03/07/2024'
+LEADING_ZERO_PATTERN = re.compile(r'\b0(?=\d)')
+
 # --- Helper Functions ---
 
 def allowed_file(filename):
@@ -59,10 +99,13 @@ def format_date_to_mdyyyy(date_series):
     Handles potential mixed types and NaT values.
     """
     datetime_series = pd.to_datetime(date_series, errors='coerce')
-    formatted_series = datetime_series.apply(
-        lambda x: f"{x.month}/{x.day}/{x.year}" if pd.notna(x) else ''
-    )
-    return formatted_series
+    # strftime formats element by element, so only the distinct dates are formatted and then
+    # spread back over the rows by code; NaT gets code -1, which picks the trailing ''
+    date_codes, unique_dates = pd.factorize(datetime_series)
+    # strftime pads month/day with zeros; strip them so the output stays M/D/YYYY
+    formatted_dates = pd.Index(unique_dates.strftime('%m/%d/%Y'), dtype=object).str.replace(LEADING_ZERO_PATTERN, '', regex=True)
+    formatted_values = np.append(formatted_dates.to_numpy(dtype=object), '')[date_codes]
+    return pd.Series(formatted_values, index=datetime_series.index, name=datetime_series.name)
 
 def clean_column_names(df):
     """
@@ -71,140 +114,169 @@ def clean_column_names(df):
     2. Replacing spaces with underscores.
     3. Removing special characters (keeping only alphanumeric and underscores).
     4. Removing leading/trailing underscores.
+    The columns of df are renamed in place and df is returned; pass df.copy(deep=False)
+    when the caller's frame must keep its original labels.
     """
-    new_columns = []
-    for col in df.columns:
-        col = str(col).strip().lower()
-        col = re.sub(r'\s+', '_', col)
-        col = re.sub(r'[^a-z0-9_]', '', col)
-        col = col.strip('_')
-        new_columns.append(col)
-    df.columns = new_columns
+    df.columns = [
+        NON_ALNUM_PATTERN.sub('', WHITESPACE_PATTERN.sub('_', str(col).strip().lower())).strip('_')
+        for col in df.columns
+    ]
     return df
 
+def column_as_str(df, col):
+    """
+    Column-wise equivalent of str(row.get(col, '')) for every row of df.
+    Returns the column converted to str, or '' when the column is missing.
+    """
+    if col in df.columns:
+        return df[col].astype(str)
+    return ''
+
+def build_channel_frame(columns):
+    """
+    Builds a DataFrame from a dict of output column -> Series/scalar and
+    reindexes it to CONSOLIDATED_OUTPUT_COLUMNS. Columns not supplied are left empty (NaN).
+    """
+    return pd.DataFrame(columns).reindex(columns=CONSOLIDATED_OUTPUT_COLUMNS)
+
+@lru_cache(maxsize=4)
+def _read_region_mapping(path, mtime):
+    # mtime is only part of the cache key, so an edited mapping file is re-read
+    return pd.read_excel(path)
+
+def load_region_mapping(path):
+    """
+    Returns the region mapping DataFrame for path, parsed once per process and
+    re-read only when the file's modification time changes. Callers must not
+    modify the returned DataFrame in place, since it is shared between requests.
+    """
+    return _read_region_mapping(path, os.path.getmtime(path))
+
+def remove_temp_dir(temp_dir):
+    """
+    Deletes a request's temporary directory, logging rather than raising on failure.
+    Runs on CLEANUP_EXECUTOR, so it must not touch flash/session.
+    """
+    try:
+        shutil.rmtree(temp_dir)
+        logging.info(f"Cleaned up temporary directory: {temp_dir}")
+    except OSError as e:
+        logging.error(f"Error removing temporary directory {temp_dir}: {e}")
+
 # --- B-Segment Allocation Functions (Fixed) ---
 
-def consolidate_data_process(df_pisa, df_esm, df_pm7):
+def consolidate_data_process(df_pisa, df_esm, df_pm7, today_date=None):
     # B-Segment Allocation code - UNCHANGED
     logging.info("Starting primary data consolidation (PISA, ESM, PM7)...")
     logging.info("Input DataFrames for primary consolidation loaded successfully!")
 
-    df_pisa = clean_column_names(df_pisa.copy())
-    df_esm = clean_column_names(df_esm.copy())
-    df_pm7 = clean_column_names(df_pm7.copy())
+    # Shallow copies: only the column labels are renamed, the callers' data blocks are shared
+    df_pisa = clean_column_names(df_pisa.copy(deep=False))
+    df_esm = clean_column_names(df_esm.copy(deep=False))
+    df_pm7 = clean_column_names(df_pm7.copy(deep=False))
 
-    all_consolidated_rows = []
-    today_date = datetime.now()
+    consolidated_frames = []
+    if today_date is None:
+        today_date = datetime.now()
     today_date_formatted = today_date.strftime("%m/%d/%Y")
 
     # --- PISA Processing ---
-    allowed_pisa_users = ["Goswami Sonali", "Patil Jayapal Gowd", "Ranganath Chilamakuri","Sridhar Divya","Sunitha S","Varunkumar N"]
     if 'assigned_user' in df_pisa.columns:
         original_pisa_count = len(df_pisa)
-        # Using .copy() after filter to avoid SettingWithCopyWarning later
-        df_pisa_filtered = df_pisa[df_pisa['assigned_user'].isin(allowed_pisa_users)].copy()
+        # The filtered frame is only read from below, so no .copy() is needed
+        df_pisa_filtered = df_pisa.loc[df_pisa['assigned_user'].isin(ALLOWED_PISA_USERS)]
         logging.info(f"\nPISA file filtered. Original records: {original_pisa_count}, Records after filter: {len(df_pisa_filtered)}")
     else:
         logging.warning("\nWarning: 'assigned_user' column not found in PISA file (after cleaning). No filter applied.")
-        df_pisa_filtered = df_pisa.copy()
+        df_pisa_filtered = df_pisa
 
     if 'barcode' not in df_pisa_filtered.columns:
         logging.error("Error: 'barcode' column not found in PISA file (after cleaning). Skipping PISA processing.")
     else:
-        df_pisa_filtered['barcode'] = df_pisa_filtered['barcode'].astype(str)
-        for index, row in df_pisa_filtered.iterrows():
-            new_row = {
-                'Barcode': row['barcode'],
-                'Company code': str(row.get('company_code', '')), # Defensive str conversion
-                'Vendor number': str(row.get('vendor_number', '')), # Defensive str conversion
-                'Received Date': row.get('received_date'),
-                'Completion Date': None,
-                'Status': str(row.get('status', '')), # Defensive str conversion
-                'Today': today_date_formatted,
-                'Channel': 'PISA',
-                'Vendor Name': str(row.get('vendor_name', '')), # Defensive str conversion
-                'Re-Open Date': None,
-                'Allocation Date': today_date_formatted,
-                'Requester': None, 'Clarification Date': None, 'Aging': None, 'Remarks': None,
-                'Region': None, 'Processor': None, 'Category': str(row.get('subcategory', ''))
-            }
-            all_consolidated_rows.append(new_row)
+        consolidated_frames.append(build_channel_frame({
+            'Barcode': df_pisa_filtered['barcode'].astype(str),
+            'Company code': column_as_str(df_pisa_filtered, 'company_code'),
+            'Vendor number': column_as_str(df_pisa_filtered, 'vendor_number'),
+            'Received Date': df_pisa_filtered.get('received_date'),
+            'Status': column_as_str(df_pisa_filtered, 'status'),
+            'Today': today_date_formatted,
+            'Channel': 'PISA',
+            'Vendor Name': column_as_str(df_pisa_filtered, 'vendor_name'),
+            'Allocation Date': today_date_formatted,
+            'Category': column_as_str(df_pisa_filtered, 'subcategory')
+        }))
         logging.info(f"Collected {len(df_pisa_filtered)} rows from PISA.")
 
     # --- ESM Processing ---
     if 'barcode' not in df_esm.columns:
         logging.error("Error: 'barcode' column not found in ESM file (after cleaning). Skipping ESM processing.")
     else:
-        df_esm['barcode'] = df_esm['barcode'].astype(str)
-        for index, row in df_esm.iterrows():
-            new_row = {
-                'Barcode': row['barcode'],
-                'Received Date': row.get('received_date'),
-                'Status': str(row.get('state', '')), # Defensive str conversion
-                'Requester': str(row.get('opened_by', '')), # Defensive str conversion
-                'Completion Date': row.get('closed') if pd.notna(row.get('closed')) else None,
-                'Re-Open Date': row.get('updated') if (str(row.get('state', '')).lower() == 'reopened') else None,
-                'Today': today_date_formatted,
-                'Remarks': str(row.get('short_description', '')), # Defensive str conversion
-                'Channel': 'ESM',
-                'Company code': str(row.get('company_code', '')),'Vendor Name': str(row.get('vendor_name', '')), # Keep None, will be filled if needed later
-                'Vendor number': str(row.get('vendor_number', '')),
-                'Allocation Date': today_date_formatted,
-                'Clarification Date': None, 'Aging': None,
-                'Region': None, 'Processor': None, 'Category': str(row.get('subcategory', ''))
-            }
-            all_consolidated_rows.append(new_row)
+        esm_state = column_as_str(df_esm, 'state')
+        # Re-Open Date is only kept for rows whose state is 'reopened' (one mask for the whole column)
+        esm_reopened = pd.Series(esm_state, index=df_esm.index).str.lower().eq('reopened')
+        esm_reopen_date = df_esm['updated'].where(esm_reopened) if 'updated' in df_esm.columns else None
+        consolidated_frames.append(build_channel_frame({
+            'Barcode': df_esm['barcode'].astype(str),
+            'Received Date': df_esm.get('received_date'),
+            'Status': esm_state,
+            'Requester': column_as_str(df_esm, 'opened_by'),
+            'Completion Date': df_esm.get('closed'),
+            'Re-Open Date': esm_reopen_date,
+            'Today': today_date_formatted,
+            'Remarks': column_as_str(df_esm, 'short_description'),
+            'Channel': 'ESM',
+            'Company code': column_as_str(df_esm, 'company_code'),
+            'Vendor Name': column_as_str(df_esm, 'vendor_name'),
+            'Vendor number': column_as_str(df_esm, 'vendor_number'),
+            'Allocation Date': today_date_formatted,
+            'Category': column_as_str(df_esm, 'subcategory')
+        }))
         logging.info(f"Collected {len(df_esm)} rows from ESM.")
 
     # --- PM7 Processing ---
     if 'barcode' not in df_pm7.columns:
         logging.error("Error: 'barcode' column not found in PM7 file (after cleaning). Skipping PM7 processing.")
     else:
-        df_pm7['barcode'] = df_pm7['barcode'].astype(str)
-
-        for index, row in df_pm7.iterrows():
-            new_row = {
-                'Barcode': row['barcode'],
-                'Vendor Name': str(row.get('vendor_name', '')), # Defensive str conversion
-                'Vendor number': str(row.get('vendor_number', '')), # Defensive str conversion
-                'Received Date': row.get('received_date'),
-                'Status': str(row.get('task', '')), # Defensive str conversion
-                'Today': today_date_formatted,
-                'Channel': 'PM7',
-                'Company code': str(row.get('company_code', '')), # Defensive str conversion
-                'Re-Open Date': None,
-                'Allocation Date': today_date_formatted, 'Completion Date': None, 'Requester': None,
-                'Clarification Date': None, 'Aging': None,
-                'Region': None, 'Processor': None, 'Category': str(row.get('subcategory', ''))
-            }
-            all_consolidated_rows.append(new_row)
+        consolidated_frames.append(build_channel_frame({
+            'Barcode': df_pm7['barcode'].astype(str),
+            'Vendor Name': column_as_str(df_pm7, 'vendor_name'),
+            'Vendor number': column_as_str(df_pm7, 'vendor_number'),
+            'Received Date': df_pm7.get('received_date'),
+            'Status': column_as_str(df_pm7, 'task'),
+            'Today': today_date_formatted,
+            'Channel': 'PM7',
+            'Company code': column_as_str(df_pm7, 'company_code'),
+            'Allocation Date': today_date_formatted,
+            'Category': column_as_str(df_pm7, 'subcategory')
+        }))
         logging.info(f"Collected {len(df_pm7)} rows from PM7.")
 
-    if not all_consolidated_rows:
+    consolidated_frames = [frame for frame in consolidated_frames if not frame.empty]
+    if not consolidated_frames:
         logging.info("No data collected for consolidation from PISA, ESM, PM7. Returning empty DataFrame.")
         return pd.DataFrame(columns=CONSOLIDATED_OUTPUT_COLUMNS)
 
-    df_consolidated = pd.DataFrame(all_consolidated_rows)
-
-    # Ensure all required columns are present in the consolidated DF
-    for col in CONSOLIDATED_OUTPUT_COLUMNS:
-        if col not in df_consolidated.columns:
-            df_consolidated[col] = None # Use None initially, will be converted to empty string later if needed
-
-    df_consolidated = df_consolidated[CONSOLIDATED_OUTPUT_COLUMNS]
+    # Each channel frame is already in CONSOLIDATED_OUTPUT_COLUMNS order
+    df_consolidated = pd.concat(consolidated_frames, ignore_index=True)
 
     # Convert known date columns to datetime objects for consistency
     # This step is crucial for the Aging calculation later
     date_cols_to_process = ['Received Date', 'Re-Open Date', 'Allocation Date', 'Completion Date', 'Clarification Date', 'Today']
-    for col in df_consolidated.columns: # Changed from date_cols_to_process to df_consolidated.columns to avoid key errors if a date col is missing
-        if col in date_cols_to_process: # Only process if it's one of the date columns we care about
-            df_consolidated[col] = pd.to_datetime(df_consolidated[col], errors='coerce')
+    # build_channel_frame guarantees every CONSOLIDATED_OUTPUT_COLUMNS column exists, so no membership scan is needed
+    for col in date_cols_to_process:
+        df_consolidated[col] = pd.to_datetime(df_consolidated[col], errors='coerce')
 
-    # Convert Barcode, Company code, Vendor number to string *before* using in sets or merges
+    # Convert Barcode, Company code, Vendor number to string *before* using in sets or merges.
+    # Barcodes are already cast per source, since concat would upcast int barcodes to float
+    # ('1001' -> '1001.0') when another source's barcode column is float; this pass blanks 'nan'.
     for col in ['Barcode', 'Company code', 'Vendor number']:
         if col in df_consolidated.columns:
             df_consolidated[col] = df_consolidated[col].astype(str).replace('nan', '')
 
+    # Low-cardinality label columns are stored as categoricals while the consolidated frame is
+    # passed between steps; Step 3 converts them back to object before writing new labels.
+    df_consolidated = df_consolidated.astype({col: 'category' for col in CATEGORICAL_OUTPUT_COLUMNS})
+
     logging.info("--- Primary Consolidated Data Process (PISA, ESM, PM7) Complete ---")
     return df_consolidated
 
@@ -213,15 +285,19 @@ def process_central_file_step2_update_existing(consolidated_df_pisa_esm_pm7, cen
     logging.info(f"\n--- Starting Central File Status Processing (Step 2: Update Existing Barcodes) ---")
 
     try:
-        # Read central file, forcing key columns to string to avoid merge issues
-        converters = {'Barcode': str, 'Vendor number': str, 'Company code': str}
-        df_central = pd.read_excel(central_file_input_path, converters=converters, keep_default_na=False)
-        df_central_cleaned = clean_column_names(df_central.copy())
+        # Read central file, forcing key columns to string to avoid merge issues.
+        # A dtype mapping is applied per column by the parser rather than calling a converter per cell.
+        key_dtypes = {'Barcode': str, 'Vendor number': str, 'Company code': str}
+        df_central = pd.read_excel(central_file_input_path, dtype=key_dtypes, keep_default_na=False)
+        df_central_cleaned = clean_column_names(df_central)
 
         # Ensure Barcode in central file is string and replace 'nan'
         if 'barcode' not in df_central_cleaned.columns:
             return False, "Error: 'barcode' column not found in the central file after cleaning. Cannot update status (Step 2)."
 
+        # Cast the central barcodes to str once; Step 2 and Step 3 compare them as-is
+        df_central_cleaned['barcode'] = df_central_cleaned['barcode'].astype(str)
+
         # Ensure 'status' column exists for subsequent logic
         if 'status' not in df_central_cleaned.columns:
             df_central_cleaned['status'] = '' # Add empty status if missing
@@ -234,35 +310,26 @@ def process_central_file_step2_update_existing(consolidated_df_pisa_esm_pm7, cen
     if 'Barcode' not in consolidated_df_pisa_esm_pm7.columns:
         return False, "Error: 'Barcode' column not found in the consolidated (PISA/ESM/PM7) file. Cannot proceed with central file processing (Step 2)."
 
-    # Barcodes from consolidated PISA, ESM, PM7 for status change logic
-    # Only if consolidated_df_pisa_esm_pm7 is not empty
-    consolidated_barcodes_for_status_change_set = set()
-    if not consolidated_df_pisa_esm_pm7.empty:
-        consolidated_barcodes_for_status_change_set = set(consolidated_df_pisa_esm_pm7['Barcode'].unique())
-
-    logging.info(f"Found {len(consolidated_barcodes_for_status_change_set)} unique barcodes from PISA/ESM/PM7 in consolidated file for Step 2 status updates.")
-
-    # Apply the status transformation only for central records whose barcodes exist in the consolidated set
-    def transform_status_if_barcode_exists(row):
-        central_barcode = str(row['barcode']) # Use the cleaned central barcode column
-        original_central_status = str(row['status']) # Ensure status is string for comparison
-
-        if central_barcode in consolidated_barcodes_for_status_change_set:
-            status_str = original_central_status.strip().lower()
-            if status_str == 'new':
-                return 'Untouched'
-            elif status_str == 'completed':
-                return 'Reopen'
-            elif status_str == 'n/a':
-                return 'New'
-            elif status_str in ['', 'na', 'none']: # If it's already 'nan' or empty-like
-                return original_central_status
-            else:
-                return original_central_status
-        else:
-            return original_central_status # If barcode not in consolidated, keep original status for now (Needs Review handled in Step 3)
-
-    df_central_cleaned['status'] = df_central_cleaned.apply(transform_status_if_barcode_exists, axis=1)
+    # Barcodes from consolidated PISA, ESM, PM7 for status change logic (matched with isin, no Python set needed)
+    consolidated_barcodes_for_status_change = consolidated_df_pisa_esm_pm7['Barcode']
+
+    logging.info(f"Found {consolidated_barcodes_for_status_change.nunique()} unique barcodes from PISA/ESM/PM7 in consolidated file for Step 2 status updates.")
+
+    # Apply the status transformation only for central records whose barcodes exist in the consolidated set.
+    # Barcodes not in consolidated keep their original status for now (Needs Review handled in Step 3),
+    # as do empty-like statuses ('', 'na', 'none').
+    original_central_status = df_central_cleaned['status'].astype(str) # Ensure status is string for comparison
+    # The transition is worked out once per distinct status value and gathered back to the rows by code
+    status_codes, status_uniques = pd.factorize(original_central_status)
+    status_uniques = pd.Series(status_uniques, dtype=object)
+    status_str = status_uniques.str.strip().str.lower()
+    transformed_status_uniques = (
+        status_str.map(CENTRAL_STATUS_TRANSITIONS).fillna(status_uniques).to_numpy(dtype=object)
+    )
+    barcode_in_consolidated = df_central_cleaned['barcode'].isin(consolidated_barcodes_for_status_change)
+    df_central_cleaned['status'] = np.where(
+        barcode_in_consolidated, transformed_status_uniques[status_codes], original_central_status
+    )
     logging.info(f"Applied status transformation logic for existing central file records ({len(df_central_cleaned)} records processed).")
 
 
@@ -285,22 +352,23 @@ def process_central_file_step2_update_existing(consolidated_df_pisa_esm_pm7, cen
             'Received Date', 'Re-Open Date', 'Allocation Date',
             'Completion Date', 'Clarification Date', 'Today'
         ]
-        for col in df_central_cleaned.columns:
-            if col in date_cols_in_central_file:
+        for col in date_cols_in_central_file:
+            if col in df_central_cleaned.columns:
                 # Convert to datetime objects for consistency before final string formatting
                 df_central_cleaned[col] = pd.to_datetime(df_central_cleaned[col], errors='coerce')
-            elif df_central_cleaned[col].dtype == 'object':
-                df_central_cleaned[col] = df_central_cleaned[col].fillna('')
-            elif col in ['Barcode', 'Vendor number', 'Company code']:
-                df_central_cleaned[col] = df_central_cleaned[col].astype(str).replace('nan', '')
 
-        # Ensure all CONSOLIDATED_OUTPUT_COLUMNS are present
-        for col in CONSOLIDATED_OUTPUT_COLUMNS:
-            if col not in df_central_cleaned.columns:
-                df_central_cleaned[col] = None # Use None for missing columns initially
+        # Remaining columns: object columns are filled in one pass, non-object key columns are cast to str
+        non_date_cols = df_central_cleaned.columns.difference(date_cols_in_central_file, sort=False)
+        object_cols = df_central_cleaned[non_date_cols].select_dtypes(include='object').columns
+        df_central_cleaned[object_cols] = df_central_cleaned[object_cols].fillna('')
+        for col in ['Barcode', 'Vendor number', 'Company code']:
+            if col in non_date_cols and col not in object_cols:
+                df_central_cleaned[col] = df_central_cleaned[col].astype(str).replace('nan', '')
 
-        # Reorder to match CONSOLIDATED_OUTPUT_COLUMNS structure
-        df_central_cleaned = df_central_cleaned[CONSOLIDATED_OUTPUT_COLUMNS]
+        # Ensure all CONSOLIDATED_OUTPUT_COLUMNS are present and reorder to match that structure in one reindex
+        missing_output_cols = pd.Index(CONSOLIDATED_OUTPUT_COLUMNS).difference(df_central_cleaned.columns, sort=False)
+        df_central_cleaned = df_central_cleaned.reindex(columns=CONSOLIDATED_OUTPUT_COLUMNS)
+        df_central_cleaned[missing_output_cols] = None # Use None for missing columns initially
 
     except Exception as e:
         return False, f"Error processing central file (Step 2) during final cleanup and remapping: {e}"
@@ -314,103 +382,94 @@ def process_central_file_step3_final_merge_and_needs_review(
     final_central_output_file_path,
     df_pisa_original, df_esm_original, df_pm7_original, # Original DFs for potential lookup/validation
     df_workon_original, df_rgba_original, df_smd_original, # Original DFs for direct mapping
-    region_mapping_df
+    region_mapping_df,
+    today_date=None # Run date shared with Step 1 so both steps stamp the same day
 ):
     # B-Segment Allocation code - FIXED TYPO
     logging.info(f"\n--- Starting Central File Status Processing (Step 3: Final Merge & Needs Review) ---")
 
-    today_date = datetime.now()
+    if today_date is None:
+        today_date = datetime.now()
     today_date_formatted = today_date.strftime("%m/%d/%Y")
 
     # Start with the central file after Step 2 updates
-    df_final_central = updated_existing_central_df.copy()
+    # It is only read until the single concat below, which builds the new working frame, so no upfront copy is taken
+    df_final_central = updated_existing_central_df
+    # Records from PISA/ESM/PM7, Workon, RGBA and SMD are collected here and appended with a single concat
+    frames_to_append = []
 
     logging.debug(f"DEBUG (Step 3): Initial df_final_central Status distribution:\n{df_final_central['Status'].value_counts(dropna=False)}")
 
-    # Get sets of barcodes for efficient lookup
-    central_barcodes_set = set(df_final_central['Barcode'].astype(str).unique())
-
-    # Ensure consolidated_pisa_esm_pm7_barcodes_set is empty if df_consolidated_pisa_esm_pm7 is empty
-    consolidated_pisa_esm_pm7_barcodes_set = set()
-    if not df_consolidated_pisa_esm_pm7.empty:
-        consolidated_pisa_esm_pm7_barcodes_set = set(df_consolidated_pisa_esm_pm7['Barcode'].astype(str).unique())
+    # Unique barcode indexes are matched with isin / Index.difference (pandas hash tables) rather than Python sets
+    central_barcodes = pd.Index(df_final_central['Barcode'].unique())
+    consolidated_pisa_esm_pm7_barcodes = pd.Index(df_consolidated_pisa_esm_pm7['Barcode'].unique())
 
     # --- 1. Add NEW records from PISA/ESM/PM7 to the central file ---
-    # These are barcodes in consolidated_pisa_esm_pm7_barcodes_set but NOT in central_barcodes_set
-    barcodes_from_pisa_esm_pm7_to_add = consolidated_pisa_esm_pm7_barcodes_set - central_barcodes_set
-    logging.info(f"Found {len(barcodes_from_pisa_esm_pm7_to_add)} new barcodes from PISA/ESM/PM7 to add to central. Their status will be 'New'.")
+    # These are barcodes in the consolidated PISA/ESM/PM7 data but NOT in the central file
+    new_barcodes = consolidated_pisa_esm_pm7_barcodes.difference(central_barcodes)
+    logging.info(f"Found {len(new_barcodes)} new barcodes from PISA/ESM/PM7 to add to central. Their status will be 'New'.")
 
-    if not df_consolidated_pisa_esm_pm7.empty and not df_consolidated_pisa_esm_pm7.empty: # Second check is redundant but safe
-        df_new_records_from_pisa_esm_pm7 = df_consolidated_pisa_esm_pm7[
-            df_consolidated_pisa_esm_pm7['Barcode'].isin(barcodes_from_pisa_esm_pm7_to_add)
-        ].copy()
-        if not df_new_records_from_pisa_esm_pm7.empty:
-            df_new_records_from_pisa_esm_pm7['Status'] = 'New' # Set status for truly new records
-            df_final_central = pd.concat([df_final_central, df_new_records_from_pisa_esm_pm7], ignore_index=True)
-            logging.info(f"Appended {len(df_new_records_from_pisa_esm_pm7)} new records from PISA/ESM/PM7 with status 'New'.")
-        else:
-            logging.info("No new PISA/ESM/PM7 records to append from the consolidated data (all already in central or no new barcodes).")
-    else:
+    if df_consolidated_pisa_esm_pm7.empty:
         logging.info("Consolidated PISA/ESM/PM7 DataFrame was empty, so no new records to append from it.")
-
-    logging.debug(f"DEBUG (Step 3): Status distribution after adding new PISA/ESM/PM7 records:\n{df_final_central['Status'].value_counts(dropna=False)}")
+    elif new_barcodes.empty:
+        # Every consolidated barcode is already in central, so the row mask and slice are skipped
+        logging.info("No new PISA/ESM/PM7 records to append from the consolidated data (all already in central or no new barcodes).")
+    else:
+        new_barcode_mask = ~df_consolidated_pisa_esm_pm7['Barcode'].isin(central_barcodes)
+        df_new_records_from_pisa_esm_pm7 = df_consolidated_pisa_esm_pm7[new_barcode_mask].copy()
+        df_new_records_from_pisa_esm_pm7['Status'] = 'New' # Set status for truly new records
+        frames_to_append.append(df_new_records_from_pisa_esm_pm7)
+        logging.info(f"Appending {len(df_new_records_from_pisa_esm_pm7)} new records from PISA/ESM/PM7 with status 'New'.")
 
     # --- 2. Mark 'Needs Review' for central records not found in PISA/ESM/PM7 consolidated ---
-    # These are barcodes in central_barcodes_set but NOT in consolidated_pisa_esm_pm7_barcodes_set
-    barcodes_for_needs_review = central_barcodes_set - consolidated_pisa_esm_pm7_barcodes_set
-    logging.info(f"Found {len(barcodes_for_needs_review)} barcodes in original central not in PISA/ESM/PM7 consolidated sources, applying 'Needs Review' logic.")
+    # These are barcodes in the central file but NOT in the consolidated PISA/ESM/PM7 data.
+    # New PISA/ESM/PM7 records are not appended yet, so the mask only covers original central records.
+    needs_review_barcodes = central_barcodes.difference(consolidated_pisa_esm_pm7_barcodes)
+    logging.info(f"Found {len(needs_review_barcodes)} barcodes in original central not in PISA/ESM/PM7 consolidated sources, applying 'Needs Review' logic.")
 
-    # Apply 'Needs Review' only to records whose barcodes are in `barcodes_for_needs_review`
-    # AND whose status is NOT 'Completed'.
-    needs_review_mask = df_final_central['Barcode'].isin(barcodes_for_needs_review)
-    not_completed_mask = ~(df_final_central['Status'].astype(str).str.strip().str.lower() == 'completed')
+    # Row positions in the central frame to mark 'Needs Review'; written after the concat, where they are unchanged
+    needs_review_positions = np.array([], dtype=np.intp)
+    if not needs_review_barcodes.empty:
+        needs_review_mask = ~df_final_central['Barcode'].isin(consolidated_pisa_esm_pm7_barcodes)
 
-    # Combine masks and apply 'Needs Review'
-    df_final_central.loc[needs_review_mask & not_completed_mask, 'Status'] = 'Needs Review'
-    logging.info(f"Updated {(needs_review_mask & not_completed_mask).sum()} records to 'Needs Review'.")
-    logging.debug(f"DEBUG (Step 3): Status distribution after 'Needs Review' logic:\n{df_final_central['Status'].value_counts(dropna=False)}")
+        # Apply 'Needs Review' only to records whose barcodes are not in consolidated
+        # AND whose status is NOT 'Completed'.
+        # Status holds only a handful of distinct values, so strip/lower runs on those once and is mapped back by code
+        status_codes, status_uniques = pd.factorize(df_final_central['Status'].astype(str))
+        is_completed_status = (pd.Index(status_uniques).str.strip().str.lower() == 'completed')
+        not_completed_mask = ~is_completed_status[status_codes]
+
+        # Combine masks; 'Needs Review' is applied once the working frame exists
+        needs_review_positions = np.flatnonzero(needs_review_mask.to_numpy() & not_completed_mask)
+    logging.info(f"Updated {len(needs_review_positions)} records to 'Needs Review'.")
 
 
     # --- 3. Directly map and append Workon P71 records ---
     if df_workon_original is not None and not df_workon_original.empty:
-        df_workon_cleaned = clean_column_names(df_workon_original.copy())
+        df_workon_cleaned = clean_column_names(df_workon_original.copy(deep=False))
         if 'key' not in df_workon_cleaned.columns:
             logging.error("Error: 'key' column not found in Workon file (after cleaning). Skipping Workon processing.")
         else:
-            workon_records_to_append = []
-            for index, row in df_workon_cleaned.iterrows():
-                new_row = {
-                    'Barcode': str(row.get('key', '')), # Defensive str conversion
-                    'Processor': 'Jayapal',
-                    'Channel': 'Workon',
-                    'Category': str(row.get('action', '')), # Defensive str conversion
-                    'Company code': str(row.get('company_code', '')), # Defensive str conversion
-                    'Region': str(row.get('country', '')), # Defensive str conversion
-                    'Vendor number': str(row.get('vendor_number', '')), # Defensive str conversion
-                    'Vendor Name': str(row.get('name', '')), # Defensive str conversion
-                    'Status': str(row.get('status', '')), # Defensive str conversion
-                    'Received Date': row.get('updated'),
-                    'Re-Open Date': None,
-                    'Allocation Date': today_date_formatted,
-                    'Clarification Date': None,
-                    'Completion Date': None,
-                    'Requester': str(row.get('applicant', '')), # Defensive str conversion
-                    'Remarks': str(row.get('summary', '')), # Defensive str conversion
-                    'Aging': None,
-                    'Today': today_date_formatted
-                }
-                workon_records_to_append.append(new_row)
-            if workon_records_to_append:
-                df_workon_appended = pd.DataFrame(workon_records_to_append)
-                # Ensure all CONSOLIDATED_OUTPUT_COLUMNS are present, filling missing with None
-                df_workon_appended = df_workon_appended.reindex(columns=CONSOLIDATED_OUTPUT_COLUMNS)
-                df_final_central = pd.concat([df_final_central, df_workon_appended], ignore_index=True)
-                logging.info(f"Appended {len(df_workon_appended)} records from Workon P71 directly.")
-            else:
-                logging.info("No records to append from Workon P71 after mapping.")
+            df_workon_appended = build_channel_frame({
+                'Barcode': df_workon_cleaned['key'].astype(str),
+                'Processor': 'Jayapal',
+                'Channel': 'Workon',
+                'Category': column_as_str(df_workon_cleaned, 'action'),
+                'Company code': column_as_str(df_workon_cleaned, 'company_code'),
+                'Region': column_as_str(df_workon_cleaned, 'country'),
+                'Vendor number': column_as_str(df_workon_cleaned, 'vendor_number'),
+                'Vendor Name': column_as_str(df_workon_cleaned, 'name'),
+                'Status': column_as_str(df_workon_cleaned, 'status'),
+                'Received Date': df_workon_cleaned.get('updated'),
+                'Allocation Date': today_date_formatted,
+                'Requester': column_as_str(df_workon_cleaned, 'applicant'),
+                'Remarks': column_as_str(df_workon_cleaned, 'summary'),
+                'Today': today_date_formatted
+            })
+            frames_to_append.append(df_workon_appended)
+            logging.info(f"Appending {len(df_workon_appended)} records from Workon P71 directly.")
     else:
         logging.info("Workon file not provided or is empty. Skipping Workon processing.")
-    logging.debug(f"DEBUG (Step 3): Status distribution after Workon append:\n{df_final_central['Status'].value_counts(dropna=False)}")
 
 
     # --- 4. Directly map and append RGBA records ---
@@ -420,11 +479,12 @@ def process_central_file_step3_final_merge_and_needs_review(
     elif df_rgba_original.empty:
         logging.info("RGBA original DataFrame is empty. Skipping RGBA processing.")
     else:
-        df_rgba_cleaned = clean_column_names(df_rgba_original.copy())
+        df_rgba_cleaned = clean_column_names(df_rgba_original.copy(deep=False))
         logging.info(f"RGBA file has {len(df_rgba_cleaned)} records after cleaning column names.")
 
         # --- FILTER REMOVED ---
-        df_rgba_filtered = df_rgba_cleaned.copy()
+        # No filter, so the cleaned frame is used as-is rather than copied again
+        df_rgba_filtered = df_rgba_cleaned
         logging.info("RGBA 'current_assignee' filter has been explicitly removed. All RGBA records will be considered.")
         # --- END FILTER REMOVED ---
 
@@ -434,91 +494,77 @@ def process_central_file_step3_final_merge_and_needs_review(
             logging.error("Error: 'key' column not found in RGBA file after cleaning. Skipping RGBA processing.")
             logging.debug(f"Columns available in filtered RGBA: {df_rgba_filtered.columns.tolist()}")
         else:
-            rgba_records_to_append = []
-            for index, row in df_rgba_filtered.iterrows():
-                # Log a sample of row data for debugging
-                if index < 5: # Log first 5 rows for inspection
-                    logging.debug(f"Processing RGBA row (sample): Barcode={row.get('key')}, Company_code={row.get('company_code')}, Updated={row.get('updated')}")
-
-                new_row = {
-                    'Barcode': str(row.get('key', '')), # Defensive str conversion
-                    'Processor': 'Divya',
-                    'Channel': 'Workon', # Confirmed: Channel for RGBA is 'Workon'
-                    'Category': None,
-                    'Company code': str(row.get('company_code', '')), # Defensive str conversion
-                    'Region': None, # Will be filled by region mapping later if not present
-                    'Vendor number': None,
-                    'Vendor Name': None,
-                    'Status': None,
-                    'Received Date': row.get('updated'),
-                    'Re-Open Date': None,
-                    'Allocation Date': today_date_formatted,
-                    'Clarification Date': None,
-                    'Completion Date': None,
-                    'Requester': None,
-                    'Remarks': str(row.get('summary', '')), # Defensive str conversion
-                    'Aging': None,
-                    'Today': today_date_formatted
-                }
-                rgba_records_to_append.append(new_row)
-            if rgba_records_to_append:
-                df_rgba_appended = pd.DataFrame(rgba_records_to_append)
-                df_rgba_appended = df_rgba_appended.reindex(columns=CONSOLIDATED_OUTPUT_COLUMNS)
-                df_final_central = pd.concat([df_final_central, df_rgba_appended], ignore_index=True)
-                logging.info(f"Successfully appended {len(df_rgba_appended)} records from RGBA directly.")
-            else:
-                logging.info("No records generated from RGBA for appending after individual row processing (might be due to missing keys or unexpected values).")
-    logging.debug(f"DEBUG (Step 3): Status distribution after RGBA append:\n{df_final_central['Status'].value_counts(dropna=False)}")
+            # Log a sample of row data for debugging
+            logging.debug(f"Processing RGBA rows (sample):\n{df_rgba_filtered.head(5).reindex(columns=['key', 'company_code', 'updated'])}")
+
+            df_rgba_appended = build_channel_frame({
+                'Barcode': df_rgba_filtered['key'].astype(str),
+                'Processor': 'Divya',
+                'Channel': 'Workon', # Confirmed: Channel for RGBA is 'Workon'
+                'Company code': column_as_str(df_rgba_filtered, 'company_code'),
+                'Received Date': df_rgba_filtered.get('updated'),
+                'Allocation Date': today_date_formatted,
+                'Remarks': column_as_str(df_rgba_filtered, 'summary'),
+                'Today': today_date_formatted
+            })
+            frames_to_append.append(df_rgba_appended)
+            logging.info(f"Appending {len(df_rgba_appended)} records from RGBA directly.")
 
 
     # --- 5. Directly map and append SMD records ---
     if df_smd_original is not None and not df_smd_original.empty:
-        df_smd_cleaned = clean_column_names(df_smd_original.copy())
-        smd_records_to_append = []
-        for index, row in df_smd_cleaned.iterrows():
-            new_row = {
-                'Barcode': None, # As no explicit barcode column was given for SMD, keeping it None.
-                'Processor': None,
-                'Channel': 'SMD',
-                'Category': None,
-                'Company code': str(row.get('ekorg', '')), # Defensive str conversion
-                'Region': str(row.get('material_field', '')), # Defensive str conversion
-                'Vendor number': str(row.get('pmd-sno', '')), # Defensive str conversion
-                'Vendor Name': str(row.get('supplier_name', '')), # Defensive str conversion
-                'Status': None,
-                'Received Date': row.get('request_date'),
-                'Re-Open Date': None,
-                'Allocation Date': today_date_formatted,
-                'Clarification Date': None,
-                'Completion Date': None,
-                'Requester': str(row.get('requested_by', '')), # Defensive str conversion
-                'Remarks': None,
-                'Aging': None,
-                'Today': today_date_formatted
-            }
-            smd_records_to_append.append(new_row)
-        if smd_records_to_append:
-            df_smd_appended = pd.DataFrame(smd_records_to_append)
-            df_smd_appended = df_smd_appended.reindex(columns=CONSOLIDATED_OUTPUT_COLUMNS)
-            df_final_central = pd.concat([df_final_central, df_smd_appended], ignore_index=True)
-            logging.info(f"Appended {len(df_smd_appended)} records from SMD directly.")
-        else:
-            logging.info("No records to append from SMD after mapping.")
+        df_smd_cleaned = clean_column_names(df_smd_original.copy(deep=False))
+        # As no explicit barcode column was given for SMD, Barcode is left empty.
+        df_smd_appended = build_channel_frame({
+            'Channel': pd.Series('SMD', index=df_smd_cleaned.index),
+            'Company code': column_as_str(df_smd_cleaned, 'ekorg'),
+            'Region': column_as_str(df_smd_cleaned, 'material_field'),
+            'Vendor number': column_as_str(df_smd_cleaned, 'pmd-sno'),
+            'Vendor Name': column_as_str(df_smd_cleaned, 'supplier_name'),
+            'Received Date': df_smd_cleaned.get('request_date'),
+            'Allocation Date': today_date_formatted,
+            'Requester': column_as_str(df_smd_cleaned, 'requested_by'),
+            'Today': today_date_formatted
+        })
+        frames_to_append.append(df_smd_appended)
+        logging.info(f"Appending {len(df_smd_appended)} records from SMD directly.")
     else:
         logging.info("SMD file not provided or is empty. Skipping SMD processing.")
-    logging.debug(f"DEBUG (Step 3): Status distribution after SMD append:\n{df_final_central['Status'].value_counts(dropna=False)}")
+
+    # One concat for all sources instead of re-copying the growing central frame per source
+    # Both branches produce a new frame, so the Step 2 DataFrame is never modified
+    if frames_to_append:
+        df_final_central = pd.concat([df_final_central] + frames_to_append, ignore_index=True)
+        logging.info(f"Appended {sum(len(frame) for frame in frames_to_append)} records in total to the central file.")
+    else:
+        df_final_central = df_final_central.reset_index(drop=True)
+
+    # pd.concat keeps a categorical column when the central side is empty or all-NA, and a
+    # categorical rejects the new labels written below, so these columns go back to object here
+    df_final_central = df_final_central.astype(
+        {col: object for col in CATEGORICAL_OUTPUT_COLUMNS if col in df_final_central.columns}, copy=False
+    )
+
+    # The central rows come first, so their positions are unchanged; a positional write into the
+    # Status column skips the label lookup and alignment that .loc would do
+    df_final_central.iloc[needs_review_positions, df_final_central.columns.get_loc('Status')] = 'Needs Review'
+    logging.debug(f"DEBUG (Step 3): Status distribution after appending all sources:\n{df_final_central['Status'].value_counts(dropna=False)}")
 
 
     # --- 6. Handle blank Company Code for PM7 channel (Applies to all PM7 records in df_final_central) ---
     logging.info("\n--- Applying PM7 Company Code population logic ---")
     if 'Channel' in df_final_central.columns and 'Company code' in df_final_central.columns and 'Barcode' in df_final_central.columns:
-        pm7_blank_cc_mask = (df_final_central['Channel'] == 'PM7') & \
-                            (df_final_central['Company code'].astype(str).replace('nan', '').str.strip() == '')
-
-        # Ensure Barcode is not None/empty before slicing
+        # String checks only run on the PM7 rows rather than on the whole Company code column
+        is_pm7 = (df_final_central['Channel'] == 'PM7').to_numpy()
+        pm7_blank_cc_mask = is_pm7.copy()
+        pm7_blank_cc_mask[is_pm7] = (
+            df_final_central['Company code'][is_pm7].astype(str).replace('nan', '').str.strip() == ''
+        ).to_numpy()
+
+        # Ensure Barcode is not None/empty before slicing; barcodes shorter than 4 characters give ''
         valid_barcodes_for_pm7 = df_final_central.loc[pm7_blank_cc_mask, 'Barcode'].astype(str).str.strip()
         df_final_central.loc[pm7_blank_cc_mask, 'Company code'] = \
-            valid_barcodes_for_pm7.apply(lambda x: x[:4] if len(x) >= 4 else '')
+            valid_barcodes_for_pm7.str[:4].where(valid_barcodes_for_pm7.str.len() >= 4, '')
 
         logging.info(f"Populated Company Code for {pm7_blank_cc_mask.sum()} PM7 records based on Barcode.")
     else:
@@ -530,68 +576,69 @@ def process_central_file_step3_final_merge_and_needs_review(
     logging.info("\n--- Applying Region Mapping ---")
     if region_mapping_df is None or region_mapping_df.empty:
         logging.warning("Warning: Region mapping file not provided or is empty. Region column will not be populated by external mapping.")
-        if 'Region' not in df_final_central.columns:
-            df_final_central['Region'] = ''
-        df_final_central['Region'] = df_final_central['Region'].fillna('')
+        # Region is created blank or has its NaNs filled in a single assignment
+        df_final_central['Region'] = df_final_central['Region'].fillna('') if 'Region' in df_final_central.columns else ''
     else:
-        region_mapping_df = clean_column_names(region_mapping_df.copy())
+        region_mapping_df = clean_column_names(region_mapping_df.copy(deep=False))
         if 'r3_coco' not in region_mapping_df.columns or 'region' not in region_mapping_df.columns:
             logging.error("Error: Region mapping file must contain 'r3_coco' and 'region' columns after cleaning. Skipping region mapping.")
-            if 'Region' not in df_final_central.columns:
-                df_final_central['Region'] = ''
-            df_final_central['Region'] = df_final_central['Region'].fillna('')
+            df_final_central['Region'] = df_final_central['Region'].fillna('') if 'Region' in df_final_central.columns else ''
         else:
-            region_map = {}
-            for idx, row in region_mapping_df.iterrows():
-                coco_key = str(row['r3_coco']).strip().upper()
-                if coco_key:
-                    region_map[coco_key[:4]] = str(row['region']).strip()
+            # Keys are the first 4 characters of the upper-cased R/3 CoCo; later rows win on duplicate keys
+            coco_keys = region_mapping_df['r3_coco'].astype(str).str.strip().str.upper()
+            mapped_region_values = region_mapping_df['region'].astype(str).str.strip()
+            has_coco_key = coco_keys != ''
+            # Held as a uniquely indexed Series so Series.map resolves all rows with one index lookup
+            region_map = pd.Series(mapped_region_values[has_coco_key].values, index=coco_keys[has_coco_key].str[:4].values)
+            region_map = region_map[~region_map.index.duplicated(keep='last')]
 
             logging.info(f"Loaded {len(region_map)} unique R/3 CoCo -> Region mappings.")
 
             if 'Company code' in df_final_central.columns:
-                # Ensure 'Company code' column is string before lookup
-                df_final_central['Company code_lookup'] = df_final_central['Company code'].astype(str).str.strip().str.upper().str[:4]
+                # Ensure 'Company code' column is string before lookup. Company codes repeat heavily, so the
+                # codes are dictionary-encoded: only the distinct values are normalised and mapped, then
+                # the regions are gathered back to the rows by code.
+                company_code_codes, unique_company_codes = pd.factorize(df_final_central['Company code'].astype(str))
+                unique_lookup_keys = pd.Series(unique_company_codes, dtype=object).str.strip().str.upper().str[:4]
+                unique_mapped_regions = unique_lookup_keys.map(region_map).to_numpy(dtype=object)
 
-                new_mapped_regions = df_final_central['Company code_lookup'].map(region_map)
+                new_mapped_regions = pd.Series(unique_mapped_regions[company_code_codes], index=df_final_central.index)
 
                 if 'Region' not in df_final_central.columns: # FIX: Changed df_final_columns to df_final_central.columns
                     df_final_central['Region'] = ''
 
-                # Fill NaN (or originally empty string, now pd.NA from fillna) in 'Region' with new_mapped_regions
-                # This ensures existing regions are preserved, and only blanks/NaNs get mapped
-                df_final_central['Region'] = df_final_central['Region'].replace('', pd.NA).fillna(new_mapped_regions)
-
-                df_final_central['Region'] = df_final_central['Region'].astype(str).replace('nan', '')
+                # Existing regions are preserved; only blank ('') or NaN regions take new_mapped_regions,
+                # chosen with one mask instead of a replace + fillna round trip
+                existing_regions = df_final_central['Region']
+                keep_existing_region = existing_regions.notna() & existing_regions.ne('')
+                df_final_central['Region'] = existing_regions.where(keep_existing_region, new_mapped_regions) \
+                    .astype(str).replace('nan', '')
 
-                df_final_central = df_final_central.drop(columns=['Company code_lookup'])
                 logging.info("Region mapping applied successfully. Existing regions prioritized.")
             else:
                 logging.warning("Warning: 'Company code' column not found in final central DataFrame. Cannot apply region mapping.")
-                if 'Region' not in df_final_central.columns:
-                    df_final_central['Region'] = ''
-                df_final_central['Region'] = df_final_central['Region'].fillna('')
+                df_final_central['Region'] = df_final_central['Region'].fillna('') if 'Region' in df_final_central.columns else ''
     logging.debug(f"DEBUG (Step 3): Status distribution after Region Mapping logic:\n{df_final_central['Status'].value_counts(dropna=False)}")
 
     # --- 8. Calculate 'Aging' ---
     logging.info("\n--- Calculating 'Aging' column ---")
     if 'Today' in df_final_central.columns and 'Allocation Date' in df_final_central.columns:
-        # Ensure 'Today' and 'Allocation Date' are in datetime format for calculation
-        df_final_central['Today_dt'] = pd.to_datetime(df_final_central['Today'], errors='coerce')
-        df_final_central['Allocation Date_dt'] = pd.to_datetime(df_final_central['Allocation Date'], errors='coerce')
+        # Ensure 'Today' and 'Allocation Date' are in datetime format for calculation.
+        # They are kept as datetimes so the final date formatting does not need to re-parse them.
+        df_final_central['Today'] = pd.to_datetime(df_final_central['Today'], errors='coerce')
+        df_final_central['Allocation Date'] = pd.to_datetime(df_final_central['Allocation Date'], errors='coerce')
 
         # Calculate difference and extract days
         # Use .dt.days for timedelta objects, handle NaT results from errors='coerce'
-        df_final_central['Aging'] = (df_final_central['Today_dt'] - df_final_central['Allocation Date_dt']).dt.days
+        aging_days = (df_final_central['Today'] - df_final_central['Allocation Date']).dt.days
 
         # Replace NaN in 'Aging' with empty string or 0 as per requirement
         # For 'Aging', 0 might be more appropriate than empty string for numerical column
-        df_final_central['Aging'] = df_final_central['Aging'].fillna('').astype(str).replace('nan', '') # Convert to string to match other empty values
+        # fillna('') already removes every NaN, so no 'nan' strings can come out of astype(str)
+        df_final_central['Aging'] = aging_days.fillna('').astype(str) # Convert to string to match other empty values
         # If you prefer 0 for missing dates:
-        # df_final_central['Aging'] = df_final_central['Aging'].fillna(0).astype(int)
+        # df_final_central['Aging'] = aging_days.fillna(0).astype(int)
 
-        # Drop the temporary datetime columns
-        df_final_central = df_final_central.drop(columns=['Today_dt', 'Allocation Date_dt'])
         logging.info("'Aging' column calculated successfully.")
     else:
         logging.warning("Warning: 'Today' or 'Allocation Date' columns missing. Cannot calculate 'Aging'.")
@@ -606,28 +653,32 @@ def process_central_file_step3_final_merge_and_needs_review(
         'Received Date', 'Re-Open Date', 'Allocation Date',
         'Completion Date', 'Clarification Date', 'Today'
     ]
-    for col in CONSOLIDATED_OUTPUT_COLUMNS: # Iterate through all output columns for final formatting
+    for col in date_cols_in_central_file:
         if col in df_final_central.columns:
-            if col in date_cols_in_central_file:
-                df_final_central[col] = format_date_to_mdyyyy(df_final_central[col])
-            # Ensure other object columns are correctly handled as strings/empty strings
-            elif df_final_central[col].dtype == 'object':
-                df_final_central[col] = df_final_central[col].fillna('')
-            # Barcode, Vendor number, Company code are already handled to str at their source.
-            # This handles any remaining cases that might not have been caught
-            elif col in ['Barcode', 'Vendor number', 'Company code'] and df_final_central[col].dtype != 'object':
-                df_final_central[col] = df_final_central[col].astype(str).replace('nan', '')
-        else:
-            df_final_central[col] = '' # Ensure all output columns exist, fill missing as empty string
-
-    # Reorder columns to ensure final output matches specification
-    df_final_central = df_final_central[CONSOLIDATED_OUTPUT_COLUMNS]
+            df_final_central[col] = format_date_to_mdyyyy(df_final_central[col])
+
+    # Ensure other object columns are correctly handled as strings/empty strings, in one fill
+    text_cols = [col for col in CONSOLIDATED_OUTPUT_COLUMNS
+                 if col in df_final_central.columns and col not in date_cols_in_central_file]
+    object_cols = df_final_central[text_cols].select_dtypes(include='object').columns
+    df_final_central[object_cols] = df_final_central[object_cols].fillna('')
+
+    # Barcode, Vendor number, Company code are already handled to str at their source.
+    # This handles any remaining cases that might not have been caught
+    for col in ['Barcode', 'Vendor number', 'Company code']:
+        if col in df_final_central.columns and col not in object_cols:
+            df_final_central[col] = df_final_central[col].astype(str).replace('nan', '')
+
+    # Reorder columns to ensure final output matches specification; missing output columns are added as empty strings
+    df_final_central = df_final_central.reindex(columns=CONSOLIDATED_OUTPUT_COLUMNS, fill_value='')
     logging.debug(f"DEBUG: Final Status column before saving:\n{df_final_central['Status'].value_counts(dropna=False)}")
     logging.debug(f"DEBUG: Final sample rows before saving:\n{df_final_central[['Barcode', 'Channel', 'Status', 'Today', 'Allocation Date', 'Aging']].head(10)}")
 
 
     try:
-        df_final_central.to_excel(final_central_output_file_path, index=False)
+        with pd.ExcelWriter(final_central_output_file_path, engine='xlsxwriter',
+                            engine_kwargs={'options': XLSXWRITER_OPTIONS}) as writer:
+            df_final_central.to_excel(writer, index=False)
         logging.info(f"Final central file (after Step 3) saved to: {final_central_output_file_path}")
         logging.info(f"Total rows in final central file (after Step 3): {len(df_final_central)}")
     except Exception as e:
@@ -657,7 +708,7 @@ def process_b_segment_allocation_core(request_files, temp_dir):
         if allowed_file(file.filename):
             filename = secure_filename(file.filename)
             file_path = os.path.join(temp_dir, filename)
-            file.save(file_path)
+            file.save(file_path, buffer_size=UPLOAD_COPY_BUFFER_SIZE)
             uploaded_files[key] = file_path
             flash(f'File "{filename}" uploaded successfully.', 'info')
         else:
@@ -671,7 +722,7 @@ def process_b_segment_allocation_core(request_files, temp_dir):
             if allowed_file(file.filename):
                 filename = secure_filename(file.filename)
                 file_path = os.path.join(temp_dir, filename)
-                file.save(file_path)
+                file.save(file_path, buffer_size=UPLOAD_COPY_BUFFER_SIZE)
                 uploaded_files[key] = file_path
                 flash(f'Optional file "{filename}" uploaded successfully.', 'info')
             else:
@@ -689,59 +740,66 @@ def process_b_segment_allocation_core(request_files, temp_dir):
     smd_file_path = uploaded_files['smd_file'] # This will be path or None
     initial_central_file_input_path = uploaded_files['b_segment_central_file']
 
-    df_pisa_original = None
-    df_esm_original = None
-    df_pm7_original = None
     df_workon_original = pd.DataFrame() # Initialize as empty DataFrame if not provided
     df_rgba_original = pd.DataFrame() # Initialize as empty DataFrame if not provided
     df_smd_original = pd.DataFrame() # Initialize as empty DataFrame if not provided
     df_region_mapping = pd.DataFrame()
 
-    try:
-        df_pisa_original = pd.read_excel(pisa_file_path)
-        df_esm_original = pd.read_excel(esm_file_path)
-        df_pm7_original = pd.read_excel(pm7_file_path)
-
-        # Handle optional files: check if path exists before reading
-        if workon_file_path and os.path.exists(workon_file_path):
-            df_workon_original = pd.read_excel(workon_file_path)
-        else:
-            logging.info("Workon P71 file not loaded (not provided, invalid, or empty).")
+    # Handle optional files: check if path exists before reading
+    input_file_paths = {'pisa_file': pisa_file_path, 'esm_file': esm_file_path, 'pm7_file': pm7_file_path}
+    if workon_file_path and os.path.exists(workon_file_path):
+        input_file_paths['workon_file'] = workon_file_path
+    else:
+        logging.info("Workon P71 file not loaded (not provided, invalid, or empty).")
 
-        if rgba_file_path and os.path.exists(rgba_file_path): # Check for RGBA file
-            df_rgba_original = pd.read_excel(rgba_file_path)
-        else:
-            logging.info("RGBA file not loaded (not provided, invalid, or empty).")
+    if rgba_file_path and os.path.exists(rgba_file_path): # Check for RGBA file
+        input_file_paths['rgpa_file'] = rgba_file_path
+    else:
+        logging.info("RGBA file not loaded (not provided, invalid, or empty).")
 
-        if smd_file_path and os.path.exists(smd_file_path):
-            df_smd_original = pd.read_excel(smd_file_path)
-        else:
-            logging.info("SMD file not loaded (not provided, invalid, or empty).")
+    if smd_file_path and os.path.exists(smd_file_path):
+        input_file_paths['smd_file'] = smd_file_path
+    else:
+        logging.info("SMD file not loaded (not provided, invalid, or empty).")
 
+    # The input workbooks and the region mapping are independent, so they are parsed concurrently
+    region_mapping_future = None
+    with ThreadPoolExecutor(max_workers=len(input_file_paths) + 1) as executor:
+        read_futures = {key: executor.submit(pd.read_excel, path) for key, path in input_file_paths.items()}
         if os.path.exists(REGION_MAPPING_FILE_PATH):
-            df_region_mapping = pd.read_excel(REGION_MAPPING_FILE_PATH)
+            region_mapping_future = executor.submit(load_region_mapping, REGION_MAPPING_FILE_PATH)
+
+    input_dfs = {}
+    for key, future in read_futures.items():
+        try:
+            input_dfs[key] = future.result()
+        except Exception as e:
+            return False, f"Error loading {INPUT_FILE_LABELS[key]} file: {e}", None
+
+    df_pisa_original = input_dfs['pisa_file']
+    df_esm_original = input_dfs['esm_file']
+    df_pm7_original = input_dfs['pm7_file']
+    df_workon_original = input_dfs.get('workon_file', df_workon_original)
+    df_rgba_original = input_dfs.get('rgpa_file', df_rgba_original)
+    df_smd_original = input_dfs.get('smd_file', df_smd_original)
+
+    try:
+        if region_mapping_future is not None:
+            df_region_mapping = region_mapping_future.result()
             logging.info(f"Successfully loaded region mapping file from: {REGION_MAPPING_FILE_PATH}")
         else:
             flash(f"Warning: Region mapping file not found at {REGION_MAPPING_FILE_PATH}. Region column will be empty for records relying solely on this mapping.", 'warning')
             logging.warning(f"Region mapping file not found at {REGION_MAPPING_FILE_PATH}. Region column will be empty for records relying solely on this mapping.")
-
     except Exception as e:
-        # Be more specific about which file might have caused the error
-        error_msg = f"Error loading one or more input Excel files: {e}. Please ensure all files are valid .xlsx formats."
-        if "pisa_file" in str(e).lower() and pisa_file_path: error_msg = f"Error loading PISA file: {e}"
-        elif "esm_file" in str(e).lower() and esm_file_path: error_msg = f"Error loading ESM file: {e}"
-        elif "pm7_file" in str(e).lower() and pm7_file_path: error_msg = f"Error loading PM7 file: {e}"
-        elif "workon_file" in str(e).lower() and workon_file_path: error_msg = f"Error loading Workon file: {e}"
-        elif "rgpa_file" in str(e).lower() and rgba_file_path: error_msg = f"Error loading RGBA file: {e}"
-        elif "smd_file" in str(e).lower() and smd_file_path: error_msg = f"Error loading SMD file: {e}"
-
-        return False, error_msg, None
+        return False, f"Error loading region mapping file: {e}", None
 
-    today_str = datetime.now().strftime("%d_%m_%Y_%H%M%S")
+    # One timestamp for the whole run: output file name and the Allocation/Today dates of Steps 1 and 3
+    run_date = datetime.now()
+    today_str = run_date.strftime("%d_%m_%Y_%H%M%S")
 
     # --- Step 1: Consolidate Data (PISA, ESM, PM7 only) ---
     df_consolidated_pisa_esm_pm7 = consolidate_data_process(
-        df_pisa_original, df_esm_original, df_pm7_original
+        df_pisa_original, df_esm_original, df_pm7_original, today_date=run_date
     )
 
     # Check if df_consolidated_pisa_esm_pm7 is valid for subsequent steps
@@ -754,7 +812,9 @@ def process_b_segment_allocation_core(request_files, temp_dir):
         # consolidated_output_filename = f'ConsolidatedData_PISA_ESM_PM7_{today_str}.xlsx'
         # consolidated_output_file_path = os.path.join(temp_dir, consolidated_output_filename)
         # try:
-        #     df_consolidated_pisa_esm_pm7.to_excel(consolidated_output_file_path, index=False)
+        #     with pd.ExcelWriter(consolidated_output_file_path, engine='xlsxwriter',
+        #                         engine_kwargs={'options': XLSXWRITER_OPTIONS}) as writer:
+        #         df_consolidated_pisa_esm_pm7.to_excel(writer, index=False)
         #     logging.info(f"Primary consolidated file saved to: {consolidated_output_file_path}")
         #     session['consolidated_output_path'] = consolidated_output_file_path
         # except Exception as e:
@@ -775,7 +835,8 @@ def process_b_segment_allocation_core(request_files, temp_dir):
     success, message = process_central_file_step3_final_merge_and_needs_review(
         df_consolidated_pisa_esm_pm7, df_central_updated_existing, final_central_output_file_path,
         df_pisa_original, df_esm_original, df_pm7_original,
-        df_workon_original, df_rgba_original, df_smd_original, df_region_mapping
+        df_workon_original, df_rgba_original, df_smd_original, df_region_mapping,
+        today_date=run_date
     )
     if not success:
         return False, f'Central File Processing (Step 3) Error: {message}', None
@@ -799,7 +860,7 @@ def process_pmd_lookup_core(request_files, temp_dir):
         if allowed_file(file.filename):
             filename = secure_filename(file.filename)
             file_path = os.path.join(temp_dir, filename)
-            file.save(file_path)
+            file.save(file_path, buffer_size=UPLOAD_COPY_BUFFER_SIZE)
             uploaded_files[key] = file_path
             flash(f'PMD file "{filename}" uploaded successfully.', 'info')
         else:
@@ -809,13 +870,15 @@ def process_pmd_lookup_core(request_files, temp_dir):
     pmd_lookup_file_path = uploaded_files['pmd_lookup_file']
 
     try:
-        # Load and clean PMD Central File
-        df_central_pmd_original = pd.read_excel(pmd_central_file_path, keep_default_na=False)
-        df_central_pmd = clean_column_names(df_central_pmd_original.copy())
+        # Load PMD Central and PMD Dump files concurrently, then clean them
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            central_future = executor.submit(pd.read_excel, pmd_central_file_path, keep_default_na=False)
+            dump_future = executor.submit(pd.read_excel, pmd_lookup_file_path, keep_default_na=False)
+            df_central_pmd_original = central_future.result()
+            df_pmd_dump_original = dump_future.result()
 
-        # Load and clean PMD Dump File
-        df_pmd_dump_original = pd.read_excel(pmd_lookup_file_path, keep_default_na=False)
-        df_pmd_dump = clean_column_names(df_pmd_dump_original.copy())
+        df_central_pmd = clean_column_names(df_central_pmd_original)
+        df_pmd_dump = clean_column_names(df_pmd_dump_original)
 
         logging.info("PMD Central and PMD Dump files loaded and cleaned.")
 
@@ -862,16 +925,20 @@ def process_pmd_lookup_core(request_files, temp_dir):
     
     # Filter central file to only include 'Hold' records for direct lookup and deduplicate
     # Only records with 'hold' status will be available for matching PMD Dump records
-    df_central_hold_only = df_central_pmd[
-        df_central_pmd['status'].astype(str).str.strip().str.lower() == 'hold'
-    ].copy()
+    # Only the two columns the lookup needs are taken, so no full-width copy of the central file is made
+    df_central_hold_only = df_central_pmd.loc[
+        df_central_pmd['status'].astype(str).str.strip().str.lower() == 'hold', ['comp_key', 'assigned']
+    ]
 
     # Deduplicate `df_central_hold_only` by `comp_key` if there are multiple 'Hold' for the same key.
     # Keep the first one encountered (or apply a specific prioritization if needed).
-    df_central_hold_only_deduped = df_central_hold_only.drop_duplicates(subset=['comp_key'], keep='first').copy()
+    df_central_hold_only_deduped = df_central_hold_only.drop_duplicates(subset=['comp_key'], keep='first')
     
-    # Set index for efficient lookup for 'Hold' status matches
-    central_hold_lookup = df_central_hold_only_deduped.set_index('comp_key')
+    # Plain dict of comp_key -> assigned for 'Hold' status matches
+    central_hold_lookup = dict(zip(
+        df_central_hold_only_deduped['comp_key'],
+        df_central_hold_only_deduped['assigned'].astype(str).str.strip()
+    ))
     
     logging.info(f"Central file prepared for 'Hold' status lookup with {len(central_hold_lookup)} unique 'Hold' records.")
 
@@ -879,29 +946,17 @@ def process_pmd_lookup_core(request_files, temp_dir):
     df_pmd_dump['comp_key'] = df_pmd_dump['valid_from_key'] + '__' + df_pmd_dump['supplier_name_key']
 
     # --- Core Lookup Logic ---
-    final_pmd_records_sheet1 = [] # Will hold records for Sheet 1
-
-    for index, row in df_pmd_dump.iterrows():
-        dump_comp_key = row['comp_key']
-
-        new_record_s1 = {k: v for k, v in row.drop(['comp_key', 'valid_from_key', 'supplier_name_key']).items()}
-        
-        if dump_comp_key in central_hold_lookup.index:
-            # Match found in `central_hold_lookup`, so its status is 'Hold'
-            central_record = central_hold_lookup.loc[dump_comp_key]
-            
-            new_record_s1['Status'] = 'Hold'
-            new_record_s1['Assigned'] = str(central_record['assigned']).strip() # Get assigned from central 'Hold' record
-            final_pmd_records_sheet1.append(new_record_s1)
-            logging.debug(f"PMD Dump record {dump_comp_key} set to 'Hold' (matched central 'Hold' record).")
-        else:
-            # No match found in central_hold_lookup. This means if it doesn't match an *already 'Hold'* record in central, it's 'New'.
-            new_record_s1['Status'] = 'New'
-            new_record_s1['Assigned'] = '' # No assigned for 'New' records
-            final_pmd_records_sheet1.append(new_record_s1)
-            logging.debug(f"PMD Dump record {dump_comp_key} set to 'New' (no match in central 'Hold' records).")
-
-    df_sheet1_output = pd.DataFrame(final_pmd_records_sheet1)
+    # Sheet 1 is built column-wise: the dump columns (without the helper keys) plus Status/Assigned
+    # drop already returns a new frame, so no further .copy() is taken
+    df_sheet1_output = df_pmd_dump.drop(columns=['comp_key', 'valid_from_key', 'supplier_name_key'])
+
+    central_assigned = df_pmd_dump['comp_key'].map(central_hold_lookup)
+    hold_match_mask = central_assigned.notna()
+    # Match found in `central_hold_lookup` -> 'Hold' with the central 'assigned'.
+    # No match means it doesn't match an *already 'Hold'* record in central, so it's 'New' with no assigned.
+    df_sheet1_output['Status'] = np.where(hold_match_mask, 'Hold', 'New')
+    df_sheet1_output['Assigned'] = central_assigned.fillna('')
+    logging.info(f"PMD Dump records set to 'Hold' (matched central 'Hold' record): {hold_match_mask.sum()}, set to 'New': {(~hold_match_mask).sum()}.")
     
     # --- Final formatting and column reordering for Sheet 1 output ---
     if not df_sheet1_output.empty:
@@ -916,22 +971,17 @@ def process_pmd_lookup_core(request_files, temp_dir):
         if 'Valid From' in df_sheet1_output.columns:
             df_sheet1_output['Valid From'] = format_date_to_mdyyyy(df_sheet1_output['Valid From'])
         
-        # Add any missing output columns and reorder
-        for col in PMD_OUTPUT_SHEET1_COLUMNS:
-            if col not in df_sheet1_output.columns:
-                df_sheet1_output[col] = '' # Add missing columns as empty string
-            
-            # Ensure all object columns are handled (fillna with empty string)
-            if df_sheet1_output[col].dtype == 'object':
-                df_sheet1_output[col] = df_sheet1_output[col].fillna('')
-
-        # Final reorder of columns
-        df_sheet1_output = df_sheet1_output[PMD_OUTPUT_SHEET1_COLUMNS]
+        # Add any missing output columns as empty strings and reorder in one step
+        df_sheet1_output = df_sheet1_output.reindex(columns=PMD_OUTPUT_SHEET1_COLUMNS, fill_value='')
+
+        # Ensure all object columns are handled (fillna with empty string), in one fill
+        object_cols = df_sheet1_output.select_dtypes(include='object').columns
+        df_sheet1_output[object_cols] = df_sheet1_output[object_cols].fillna('')
     else:
         df_sheet1_output = pd.DataFrame(columns=PMD_OUTPUT_SHEET1_COLUMNS) # Ensure an empty DF with correct columns
 
     # --- Generate Sheet 2: Mapped Format ---
-    df_sheet2_output = df_sheet1_output.copy() # Start with the data from Sheet 1
+    # Sheet 2 starts from the data of Sheet 1 (renamed below)
 
     # Define the mapping from Sheet 1 columns to Sheet 2 columns
     column_mapping_s1_to_s2 = {
@@ -946,28 +996,19 @@ def process_pmd_lookup_core(request_files, temp_dir):
         'Assigned': 'Assigned' # Direct mapping
     }
 
-    # Rename columns based on the mapping
-    df_sheet2_output.rename(columns=column_mapping_s1_to_s2, inplace=True)
-
-    # Add/set static/blank columns for Sheet 2
-    # Ensure these are only added if not already created by renaming, or overwritten if they conflict
-    if 'Re-Open Date' not in df_sheet2_output.columns: df_sheet2_output['Re-Open Date'] = ''
-    if 'Allocation Date' not in df_sheet2_output.columns: df_sheet2_output['Allocation Date'] = ''
-    if 'Clarification Date' not in df_sheet2_output.columns: df_sheet2_output['Clarification Date'] = ''
-    if 'Completion Date' not in df_sheet2_output.columns: df_sheet2_output['Completion Date'] = ''
-    if 'Remarks' not in df_sheet2_output.columns: df_sheet2_output['Remarks'] = ''
-    if 'Aging' not in df_sheet2_output.columns: df_sheet2_output['Aging'] = ''
+    # Rename columns based on the mapping. copy=False shares Sheet 1's data: Sheet 2 only adds
+    # 'Today' and is then rebuilt by reindex, so Sheet 1 is never written through it.
+    df_sheet2_output = df_sheet1_output.rename(columns=column_mapping_s1_to_s2, copy=False)
+
     df_sheet2_output['Today'] = datetime.now().strftime("%m/%d/%Y") # Today's date always current
 
-    # Ensure all Sheet 2 output columns are present and in the correct order
-    for col in PMD_OUTPUT_SHEET2_COLUMNS:
-        if col not in df_sheet2_output.columns:
-            df_sheet2_output[col] = '' # Add missing columns
-        
-        if df_sheet2_output[col].dtype == 'object':
-            df_sheet2_output[col] = df_sheet2_output[col].fillna('')
+    # Ensure all Sheet 2 output columns are present and in the correct order. Static columns not created
+    # by renaming (Re-Open Date, Allocation Date, Clarification Date, Completion Date, Remarks, Aging)
+    # are added blank here together with any other missing column.
+    df_sheet2_output = df_sheet2_output.reindex(columns=PMD_OUTPUT_SHEET2_COLUMNS, fill_value='')
 
-    df_sheet2_output = df_sheet2_output[PMD_OUTPUT_SHEET2_COLUMNS]
+    object_cols = df_sheet2_output.select_dtypes(include='object').columns
+    df_sheet2_output[object_cols] = df_sheet2_output[object_cols].fillna('')
 
 
     # --- Write both DataFrames to a multi-sheet Excel file ---
@@ -976,7 +1017,8 @@ def process_pmd_lookup_core(request_files, temp_dir):
     pmd_output_file_path = os.path.join(temp_dir, pmd_output_filename)
 
     try:
-        with pd.ExcelWriter(pmd_output_file_path, engine='xlsxwriter') as writer:
+        with pd.ExcelWriter(pmd_output_file_path, engine='xlsxwriter',
+                            engine_kwargs={'options': XLSXWRITER_OPTIONS}) as writer:
             df_sheet1_output.to_excel(writer, sheet_name='PMD Lookup Result', index=False)
             df_sheet2_output.to_excel(writer, sheet_name='Mapped Format', index=False)
         logging.info(f"PMD Lookup result (multi-sheet Excel) saved to: {pmd_output_file_path}")
@@ -999,12 +1041,9 @@ def index():
     # Ensure any residual temp_dir is cleaned up when starting fresh
     temp_dir = session.get('temp_dir')
     if temp_dir and os.path.exists(temp_dir):
-        try:
-            shutil.rmtree(temp_dir)
-            logging.info(f"Cleaned up residual temporary directory: {temp_dir}")
-        except OSError as e:
-            logging.error(f"Error removing residual temporary directory {temp_dir}: {e}")
-    session.pop('temp_dir', None) # Clear session's temp_dir after cleanup attempt
+        CLEANUP_EXECUTOR.submit(remove_temp_dir, temp_dir)
+        logging.info(f"Scheduled cleanup of residual temporary directory: {temp_dir}")
+    session.pop('temp_dir', None) # Clear session's temp_dir after scheduling cleanup
 
     return render_template('index.html')
 
@@ -1101,8 +1140,8 @@ def download_file(filename):
     if file_path_in_temp and os.path.exists(file_path_in_temp):
         logging.info(f"DEBUG: File '{file_path_in_temp}' exists. Attempting to send.")
         try:
-            response = send_file(
-                file_path_in_temp,
+            response = send_from_directory(
+                temp_dir, filename,
                 mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
                 as_attachment=True,
                 download_name=filename
@@ -1121,13 +1160,9 @@ def download_file(filename):
 def cleanup_session():
     temp_dir = session.get('temp_dir')
     if temp_dir and os.path.exists(temp_dir):
-        try:
-            shutil.rmtree(temp_dir)
-            logging.info(f"Cleaned up temporary directory: {temp_dir}")
-            flash('Temporary files cleaned up.', 'info')
-        except OSError as e:
-            logging.error(f"ERROR: Error removing temporary directory {temp_dir}: {e}")
-            flash(f'Error cleaning up temporary files: {e}', 'error')
+        # Removal errors are logged by remove_temp_dir; the redirect does not wait for it
+        CLEANUP_EXECUTOR.submit(remove_temp_dir, temp_dir)
+        flash('Temporary files cleaned up.', 'info')
     session.pop('temp_dir', None)
     session.pop('consolidated_output_path', None)
     session.pop('central_output_path', None)